@@ -0,0 +1,233 @@
+#!/bin/env python
+"""
+**File:** benchmark.py
+
+Micro-benchmarks for the in-process data path of the chat servers: the
+:class:`chatserverStub.MSGQueue` reader and writer, :func:`chatserverStub.mesg_index`,
+:func:`chatserverStub.sendAll` and :func:`xserver.broadcast`.  Sockets are
+replaced by an in-memory stand-in, so only the server's own code is measured.
+
+Each benchmark is run with 1, 8, 64 and 512 threads (or sockets, for
+broadcast) and reports operations per second, the time spent waiting for the
+MSGQueue locks and the growth in live objects per operation (Python 2 has
+no allocation hooks, so this is allocations less frees of the objects the
+garbage collector tracks).  Run it
+before and after changing the queue to compare the two head to head::
+
+    python benchmark.py
+    python benchmark.py -t 1,64 -n 50000 queue-write sendAll
+"""
+
+import gc
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+import chatserverStub
+import xserver
+
+THREADS = [1, 8, 64, 512]
+OPS = 20000                 # operations per benchmark, split over the threads
+
+class FakeSocket(object):
+    "In-memory stand-in for a connected socket, it takes all that is sent."
+    def __init__(self):
+        self.nbytes = 0
+
+    def send(self, data):
+        self.nbytes += len(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+class TimedLock(object):
+    "Wraps a lock to add up the time spent waiting to acquire it."
+    def __init__(self, lock, waits):
+        self.lock = lock
+        self.waits = waits
+
+    def acquire(self, blocking=1):
+        start = time.time()
+        got = self.lock.acquire(blocking)
+        # list.append is atomic, so no lock is needed for the waits
+        self.waits.append(time.time() - start)
+        return got
+
+    def release(self):
+        self.lock.release()
+
+def timedQueue(waits):
+    "A MSGQueue with each of its locks timed"
+    q = chatserverStub.MSGQueue()
+    for name in ('mutex1', 'mutex2', 'readPending', 'writeBlock', 'readBlock'):
+        setattr(q, name, TimedLock(getattr(q, name), waits))
+    return q
+
+def fill(q, n=chatserverStub.MAX_LEN):
+    "Put n typical short chat messages in the queue"
+    for i in range(n):
+        q.writer("Message from ('127.0.0.1', 50000):\r\n\tmessage %d\r\n" % i)
+
+def runThreads(nthreads, work):
+    "Run work(ops) in nthreads threads at once, return the seconds taken"
+    ops = max(1, OPS / nthreads)
+    start = threading.Event()
+    def body():
+        start.wait()
+        work(ops)
+    threads = [threading.Thread(target=body) for i in range(nthreads)]
+    for t in threads:
+        t.start()
+    began = time.time()
+    start.set()
+    for t in threads:
+        t.join()
+    return time.time() - began, ops * nthreads
+
+def benchWrite(nthreads, waits):
+    "Every thread writes to the queue"
+    q = timedQueue(waits)
+    msg = "Message from ('127.0.0.1', 50000):\r\n\thello\r\n"
+    def work(ops):
+        for i in xrange(ops):
+            q.writer(msg)
+    return runThreads(nthreads, work)
+
+def benchRead(nthreads, waits):
+    "Every thread reads from the queue while one writer keeps adding to it"
+    q = timedQueue(waits)
+    fill(q)
+    done = threading.Event()
+    def writer():
+        while not done.isSet():
+            q.writer("Message from ('127.0.0.1', 50000):\r\n\thello\r\n")
+            time.sleep(0.001)
+    w = threading.Thread(target=writer)
+    w.start()
+    def work(ops):
+        lastread = -1
+        for i in xrange(ops):
+            reading = q.reader(lastread)
+            if reading:
+                lastread = reading[1][-1].seq
+    try:
+        return runThreads(nthreads, work)
+    finally:
+        done.set()
+        w.join()
+
+def benchMixed(nthreads, waits):
+    "Every thread writes a message and reads what is new, as handlechild does"
+    q = timedQueue(waits)
+    fill(q)
+    def work(ops):
+        lastread = -1
+        for i in xrange(ops):
+            q.writer("Message from ('127.0.0.1', 50000):\r\n\thello\r\n")
+            reading = q.reader(lastread)
+            if reading:
+                lastread = reading[1][-1].seq
+    return runThreads(nthreads, work)
+
+def benchMesgIndex(nthreads, waits):
+    "mesg_index for readers in and out of the window, with and without roll over"
+    M = chatserverStub.MAX_INDEX
+    cases = [(0, 5, 9), (0, -1, 9), (M - 5, M - 2, 3), (M - 5, 1, 3),
+             (M - 5, M - 9, 3), (10, 2, 19)]
+    mesg_index = chatserverStub.mesg_index
+    def work(ops):
+        for i in xrange(ops):
+            for old, last, new in cases:
+                mesg_index(old, last, new)
+    return runThreads(nthreads, work)
+
+def benchSendAll(nthreads, waits):
+    "Every thread is a client sending what is new in the queue to its socket"
+    q = timedQueue(waits)
+    fill(q)
+    chatserverStub.chatQueue = q
+    def work(ops):
+        client = chatserverStub.ChatClient(FakeSocket(), 'bench')
+        for i in xrange(ops):
+            q.writer("Message from ('127.0.0.1', 50000):\r\n\thello\r\n")
+            chatserverStub.sendAll(client)
+    return runThreads(nthreads, work)
+
+def benchBroadcast(nsockets, waits):
+    "xserver queues each message for every other socket, from a single thread"
+    server = FakeSocket()
+    sender = FakeSocket()
+    xserver.SOCKET_LIST[:] = [server, sender] + \
+                             [FakeSocket() for i in range(nsockets)]
+    xserver.LISTENERS[:] = [server]
+    ops = max(1, OPS / nsockets)
+    began = time.time()
+    for i in xrange(ops):
+        xserver.broadcast(server, sender, "hello\n")
+    elapsed = time.time() - began
+    del xserver.SOCKET_LIST[:]
+    del xserver.LISTENERS[:]
+    xserver.OUTBOX.clear()
+    xserver.STATS.clear()
+    xserver.QUEUED.clear()
+    return elapsed, ops
+
+BENCHMARKS = [
+    ('queue-write', benchWrite),
+    ('queue-read', benchRead),
+    ('queue-mixed', benchMixed),
+    ('mesg_index', benchMesgIndex),
+    ('sendAll', benchSendAll),
+    ('broadcast', benchBroadcast),
+]
+
+def measure(bench, nthreads):
+    """
+    Run one benchmark, returning the operations per second, the lock wait per
+    operation in micro-seconds and the net objects allocated per operation.
+    """
+    waits = []
+    # With the garbage collector off, the count of generation 0 goes up with
+    # each container object allocated and down with each one freed.
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        elapsed, ops = bench(nthreads, waits)
+        allocs = gc.get_count()[0] - before
+    finally:
+        gc.enable()
+    return (ops / elapsed, sum(waits) * 1e6 / ops, float(allocs) / ops)
+
+def main():
+    global OPS
+    parser = OptionParser(usage="%prog [options] [benchmark ...]",
+        description="Benchmarks: " + ", ".join([b[0] for b in BENCHMARKS]))
+    parser.add_option('-t', '--threads', default=','.join(map(str, THREADS)),
+                      help='comma separated thread counts [default: %default]')
+    parser.add_option('-n', '--ops', type='int', default=OPS,
+                      help='operations per benchmark [default: %default]')
+    options, args = parser.parse_args()
+    OPS = options.ops
+    threadCounts = [int(t) for t in options.threads.split(',')]
+    names = [b[0] for b in BENCHMARKS]
+    for name in args:
+        if name not in names:
+            parser.error("unknown benchmark %s" % name)
+
+    print "%-12s %7s %14s %16s %14s" % \
+          ('benchmark', 'threads', 'ops/sec', 'lock wait us/op',
+           'net allocs/op')
+    for name, bench in BENCHMARKS:
+        if args and name not in args:
+            continue
+        for nthreads in threadCounts:
+            rate, wait, allocs = measure(bench, nthreads)
+            print "%-12s %7d %14.0f %16.2f %14.2f" % \
+                  (name, nthreads, rate, wait, allocs)
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+**File:** capture.py
+
+Record the traffic that clients send to a chat server, so that it can be
+played back against a server later with replay.py.
+
+A capture file starts with MAGIC, followed by one record for each event.
+A record is a header packed as RECORD (little endian: the time as a double,
+the connection id, the event and the length of the data) and then the data.
+The events are CONNECT and CLOSE, which have no data, and DATA, which holds
+what one recv() returned.
+"""
+
+import struct
+import threading
+from itertools import count
+
+MAGIC = 'EYECAP1\n'
+RECORD = struct.Struct('<dIBI')
+CONNECT, DATA, CLOSE = range(3)
+
+class Capture(object):
+    """
+    Writes a capture file.  The server threads share one Capture, writes are
+    buffered and only hold a lock long enough to add the record to the buffer.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'wb', 64 * 1024)
+        self.file.write(MAGIC)
+        self.lock = threading.Lock()
+        self.ids = count(1)
+
+    def _write(self, when, connid, event, data=''):
+        header = RECORD.pack(when, connid, event, len(data))
+        self.lock.acquire()
+        try:
+            if self.file.closed:
+                return         # the server is shutting down
+            self.file.write(header)
+            if len(data):
+                self.file.write(data)
+        finally:
+            self.lock.release()
+
+    def connection(self, when):
+        "Record a new connection, returns its connection id"
+        connid = self.ids.next()
+        self._write(when, connid, CONNECT)
+        return connid
+
+    def data(self, when, connid, data):
+        "Record data received on a connection"
+        self._write(when, connid, DATA, data)
+
+    def closed(self, when, connid):
+        "Record that a connection was closed"
+        self._write(when, connid, CLOSE)
+
+    def close(self):
+        self.lock.acquire()
+        self.file.close()
+        self.lock.release()
+
+def read(path):
+    "Generator of the (time, connection id, event, data) records in a file"
+    f = open(path, 'rb')
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("%s is not a capture file" % path)
+    while True:
+        header = f.read(RECORD.size)
+        if len(header) < RECORD.size:
+            break          # the end, or cut short when the server stopped
+        when, connid, event, length = RECORD.unpack(header)
+        data = f.read(length)
+        if len(data) < length:
+            break
+        yield when, connid, event, data
+    f.close()
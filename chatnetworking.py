@@ -5,6 +5,10 @@ The networking portion of chat room client.
 Most of this runs in a separate thread from the main thread which manages
 the graphical interface. See wxchat.py
 
+Nothing here depends on the graphics, so scripts without a GUI, such as
+bots, load testers or a command line client, may import this module without
+loading wxPython.  They pass their own functions (or none) for the callbacks.
+
 Copyright 2009, Tim Bower. Apache Open Source License
 """
 # Copyright 2009 Tim Bower 
@@ -23,78 +27,246 @@ Copyright 2009, Tim Bower. Apache Open Source License
 # and distribute some or all of this material for use in their classes or by
 # their students.
 
+import select
 import socket
 import threading
 import subprocess
-import rendezvous
+import time
+from itertools import count
+
+import chunking
+import multicast
 
 defaulthost = 'localhost'
 port = 50000
+# A host of unix:///path connects to the server's Unix domain socket at /path
+UNIX_PREFIX = 'unix://'
+RECONNECT_TRIES = 10         # times to try to reconnect to a lost server
+RECONNECT_WAIT = 1           # seconds between the tries
+
+def _ignore(*args):
+    "Default for callbacks that are not wanted"
+    pass
 
 class ChatConnect(threading.Thread):
     """
     Run as a separate thread to make and manage the socket connection to the
     chat server.
+
+    The callbacks are called from the networking thread: *connected()* once
+    connected, *display(msg)* with each message from the server and
+    *lost(msg)* when the connection is closed or could not be made.
+
+    On the same LAN as the server, give *multicast* as a tuple of the group,
+    port and interface to get the chat messages from the server's multicast
+    group rather than over TCP (see multicast.py).
+
+    On the same host as the server, *host* may be ``unix:///path`` for the
+    server's Unix domain socket (its ``--unix`` option).
+
+    The server tells the client the index of each message it is sent.  If
+    the connection is lost (say the server was restarted), the client
+    connects again and sends ``/resume`` with that index and its nickname,
+    so it is sent just the messages it missed.
     """
-    def __init__(self, host, connected, display, lost):
+    def __init__(self, host, connected=None, display=None, lost=None,
+                 multicast=None):
         threading.Thread.__init__(self)
         self.host = host
-        self.connected = connected
-        self.display = display
-        self.lost = lost
+        self.connected = connected or _ignore
+        self.display = display or _ignore
+        self.lost = lost or _ignore
         self.msgLock = threading.Lock()
         self.numMsg = 0
         self.msg = []
+        # large messages are sent and received in chunks
+        self.msgIds = count()
+        self.reassembler = chunking.Reassembler()
+        self.multicast = multicast
+        self.subscriber = None
+        self.sequencer = None
+        # to /resume with, if the connection is lost
+        self.lastSeq = None
+        self.nick = None
+        self.quitting = False
 
     def run(self):
         "The new thread starts here to listen for data from the server"
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.settimeout(1)
-        try:
-            self.socket.connect((self.host, port))
-        except:
+        if not self.__connect():
             self.lost("Unable to connect to %s. Check the server." % self.host)
             return
         self.connected()
         while True:
-            self.__send()
+            why = self.__serve()
+            self.__close()
+            if self.quitting or not self.__reconnect():
+                self.lost(why)
+                break
+
+    def __connect(self):
+        "Connect to the server, returns False if it could not"
+        if self.host.startswith(UNIX_PREFIX):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = self.host[len(UNIX_PREFIX):]
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = (self.host, port)
+        self.socket.settimeout(1)
+        try:
+            self.socket.connect(address)
+        except:
+            self.socket.close()
+            return False
+        self.reassembler = chunking.Reassembler()
+        if self.lastSeq is None:
+            self.__control_send("/seq")
+        else:
+            self.__control_send("/resume %d %s" % (self.lastSeq,
+                                                   self.nick or ''))
+        if self.multicast:
+            # join the group before asking the server to use it,
+            # so no message is missed
+            self.subscriber = multicast.Subscriber(*self.multicast)
+            self.sequencer = multicast.Sequencer()
+            self.__control_send("/multicast")
+        return True
+
+    def __reconnect(self):
+        "Try to connect again after the connection was lost"
+        for i in range(RECONNECT_TRIES):
+            time.sleep(RECONNECT_WAIT)
+            if self.__connect():
+                self.display("*** Reconnected to the server ***\r\n")
+                return True
+        return False
+
+    def __close(self):
+        if self.sequencer and self.sequencer.expected is not None:
+            # multicast clients keep count themselves
+            self.lastSeq = (self.sequencer.expected - 1) % \
+                           self.sequencer.modulus
+        if self.subscriber:
+            self.subscriber.close()
+            self.subscriber = None
+            self.sequencer = None
+        self.socket.close()
+
+    def __serve(self):
+        """
+        Send and receive until the connection is lost, and return why it
+        was lost.
+        """
+        while True:
+            try:
+                self.__send()
+            except socket.error:
+                return "Network Connection closed..."
+            if self.subscriber:
+                readable = select.select([self.socket, self.subscriber],
+                                         [], [], 1)[0]
+                if self.subscriber in readable:
+                    try:
+                        seq, msg = self.subscriber.receive()
+                    except ValueError:
+                        seq = None    # not from the server, drop it
+                    if seq is not None:
+                        self.__show_all(*self.sequencer.datagram(seq, msg))
+                if self.socket not in readable:
+                    continue
             try:
                 data = self.socket.recv(4096)
             # Timeout once in a while just to check user input
             except socket.timeout:
                 continue
             except:  # server was stopped or had some error
-                self.lost("Network Connection closed by the server...")
-                break
-            if len(data):
-                if("/execute" in data):
-                    com=data.split("/execute",1)[1]
-                    com=com.rstrip()
-                    com=com.strip()
-                    self.display(data.split("/execute",1)[0] + "\tExecuting " +com + "\n")
-                    st=subprocess.Popen(com,stdout=subprocess.PIPE,stdin=None,stderr=subprocess.PIPE,shell=True)
-                    out,err=st.communicate()
-                    self.display(out)
-                    self.display(err)
-                else:
-                    self.display(data)
-            else:
+                return "Network Connection closed by the server..."
+            if not len(data):
                 # no data when peer does a socket.close()
-                self.lost("Network Connection closed...")
-                break
+                return "Network Connection closed..."
+            try:
+                pieces = self.reassembler.feed(data)
+            except chunking.Overflow:
+                return "Too much data from the server, disconnected..."
+            for data in pieces:
+                if data.startswith('/seq '):
+                    try:
+                        self.lastSeq = int(data.split()[1])
+                    except ValueError:
+                        pass
+                    continue
+                if self.sequencer and self.__multicast_control(data):
+                    continue
+                self.__show(data)
         # End loop of network send / recv data
-        self.socket.close()
+
+    def __show(self, data):
+        "Display a message from the server, and run it if it is a command"
+        if("/execute" in data):
+            com=data.split("/execute",1)[1]
+            com=com.rstrip()
+            com=com.strip()
+            self.display(data.split("/execute",1)[0] + "\tExecuting " +com + "\n")
+            st=subprocess.Popen(com,stdout=subprocess.PIPE,stdin=None,stderr=subprocess.PIPE,shell=True)
+            out,err=st.communicate()
+            self.display(out)
+            self.display(err)
+        else:
+            self.display(data)
+
+    def __show_all(self, ready, nack):
+        "Display the multicast messages that are ready, ask for any missed"
+        for msg in ready:
+            self.__show(msg)
+        if nack:
+            self.__control_send("/nack %d %d" % nack)
+
+    def __multicast_control(self, data):
+        """
+        Handle the server's replies about multicast, which come over TCP.
+        Returns False if data is not one of them.
+        """
+        header, rest = (data.split('\n', 1) + [''])[:2]
+        words = header.split()
+        if not len(words):
+            return False
+        try:
+            if words[0] == '/multicast':
+                self.__show_all(*self.sequencer.start(int(words[1]),
+                                                      int(words[2])))
+            elif words[0] == '/resend':
+                self.__show_all(self.sequencer.resent(int(words[1]), rest),
+                                None)
+            elif words[0] == '/gone':
+                self.__show_all(self.sequencer.gone(int(words[1]),
+                                                    int(words[2])), None)
+            else:
+                return False
+        except (IndexError, ValueError):
+            return False
+        return True
+
+    def __control_send(self, msg):
+        "Send a protocol message, framed so it arrives on its own"
+        for frame in chunking.frames(self.msgIds.next(), msg):
+            self.socket.sendall(frame)
 
     def __send(self):
         """
         Actually send a message, if one is available, to the server.
-        Need to acquire lock for the message queue.
+        Need to acquire lock for the message queue.  Messages are sent framed,
+        a large one as several chunks, which the server puts back together.
         """
         self.msgLock.acquire()
         if self.numMsg > 0:
-            self.socket.send(self.msg.pop(0))
+            msg = self.msg.pop(0)
             self.numMsg -= 1
+        else:
+            msg = None
         self.msgLock.release()
+        if msg is None:
+            return
+        for frame in chunking.frames(self.msgIds.next(), msg):
+            self.socket.sendall(frame)
 
     def send(self, msg):
         """
@@ -107,6 +279,10 @@ class ChatConnect(threading.Thread):
         the main thread.  This locking stuff is pretty simple, so it's a good
         place to see how to do the locking ourself.
         """
+        if msg.startswith('/nick') and len(msg[5:].strip()):
+            self.nick = msg[5:].strip()
+        elif msg.startswith('/quit'):
+            self.quitting = True
         self.msgLock.acquire()
         self.msg.append(msg)
         self.numMsg += 1
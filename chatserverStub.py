@@ -23,16 +23,36 @@ Copyright 2009, Tim Bower: Apache Open Source License
 # their students.
 
 import socket
+import select
 import sys
 import os
+import errno
+import signal
 import subprocess
 import threading
 import time
 #import traceback
-from itertools import cycle
+from collections import namedtuple
+from itertools import count
+from optparse import OptionParser
 
-MAX_INDEX = 100                      # The max of cyclic index
-MAX_LEN = 10                         # Message queue length
+import capture
+import chunking
+import handoff
+import multicast
+import profiler
+import snapshot
+
+MAX_INDEX = 100000                   # The max of cyclic index
+MAX_LEN = 1000                       # Most messages kept in the queue
+MAX_BYTES = 256 * 1024               # Most message bytes kept in the queue
+PRESENCE_WINDOW = 2                  # Seconds of joins and exits per digest
+SEND_BUFFER = 4 * chunking.CHUNK_SIZE  # Kernel send buffer of each client
+PUBLISH_POLL = 0.01                  # Seconds between checks for multicast
+HEARTBEAT = 1                        # Seconds between multicast heartbeats
+SNAPSHOT_INTERVAL = 5                # Seconds between snapshots (--snapshot)
+RESUME_WAIT = 0.2                    # Seconds a new client has to /resume
+REPORT_TOP = 10                      # Slowest clients listed by report()
 host = ''                            # Bind to all interfaces
 port = 50000
 
@@ -46,7 +66,14 @@ def mesg_index(old, last, new):
     should return messages.  It accounts for having a cyclic counter.
     This code is a little tricky because it has to catch all possible
     combinations.
+
+    A return value of 0 means either that the reader has not read any of the
+    messages in the queue, or that it has fallen so far behind that messages
+    it never read were removed from the queue -- see :func:`mesg_missed`.
     """
+    if last == -1:
+        # the first read gets everything, even if the index has cycled
+        return 0
     if new >= old:
         # normal case
         if last >= old and last < new:
@@ -58,10 +85,37 @@ def mesg_index(old, last, new):
         if last >= old:
             return (last - old + 1)
         elif last < new:
-            return (MAX_INDEX - old + last)
+            return (MAX_INDEX - old + last + 1)
         else:
             return 0
 
+def mesg_missed(old, last):
+    """
+    :param old: integer index of oldest (first) message in queue
+    :param last: integer index of last message read by the client thread
+
+    When :func:`mesg_index` returns 0, this gives the number of messages
+    the reader missed because they were removed from the queue before it got
+    to them.  The reader has been lapped if this is more than zero.
+    """
+    if last == -1:
+        # the first read, nothing was missed
+        return 0
+    return (old - last - 1) % MAX_INDEX
+
+def formatMsg(timeStmp, msg):
+    "A message from the queue, as it is sent to the clients"
+    return "At %s -- %s" % (time.asctime(timeStmp), msg)
+
+class Message(namedtuple('Message', 'seq stamp text')):
+    """
+    A message in the queue: its index, when it was written (in seconds since
+    the epoch) and its text, already formatted as it is sent to the clients.
+    Each message is made once by the writer and then shared by all of the
+    readers, so nothing is copied or formatted again for each client.
+    """
+    __slots__ = ()
+
 class MSGQueue(object):
     """
     Manage a queue of messages for Chat, the threads will read and write to
@@ -70,15 +124,18 @@ class MSGQueue(object):
     """
     def __init__(self):
         self.msg = []
-        self.cyclic_count = cycle(range(MAX_INDEX))
+        self.nbytes = 0                # size of the messages in self.msg
         self.current = -1
         self.readers = 0
         self.writers = 0
-        self.mutex1 = threading.Lock()
-        self.mutex2 = threading.Lock()
-        self.readPending = threading.Lock()
-        self.writeBlock = threading.Lock()
-        self.readBlock = threading.Lock()
+        self.mutex1 = profiler.TracedLock('mutex1')
+        self.mutex2 = profiler.TracedLock('mutex2')
+        self.readPending = profiler.TracedLock('readPending')
+        self.writeBlock = profiler.TracedLock('writeBlock')
+        self.readBlock = profiler.TracedLock('readBlock')
+        # count of readers that were lapped by the writers
+        self.lapped = 0
+        self.lappedLock = threading.Lock()
 
 # This is kind of complicated locking stuff. Don't worry about why there
 # are so many locks, it just came from a book showing the known solution to
@@ -93,8 +150,9 @@ class MSGQueue(object):
 # list.  Each list is a tuple containing an index number, a time stamp and
 # the message.  Each thread calls the reader on a regular basis to check if
 # there are new messages that it has not yet sent to it's client.
-# To keep the list from growing without bound, if it is at the MAX_LEN size,
-# the oldest item is removed when a new item is added.
+# To keep the list from growing without bound, when a new item is added the
+# oldest items are removed until the list holds no more than MAX_BYTES of
+# messages and no more than MAX_LEN items.  The newest item is always kept.
 
 # The basic idea of the readers and writers algorithm is to use locks to
 # quickly see how many other readers and writers there are.  writeBlock is the
@@ -109,8 +167,8 @@ class MSGQueue(object):
 # up the reader by changing the data in the middle of it being read.
 
 
-    def reader(self, lastread):
-        "Reader of readers and writers algorithm"
+    def _startRead(self):
+        "Entry section of the reader"
         self.readPending.acquire()
         self.readBlock.acquire()
         self.mutex1.acquire()
@@ -119,163 +177,823 @@ class MSGQueue(object):
         self.mutex1.release()
         self.readBlock.release()
         self.readPending.release()
-        # here is the critical section
-        if lastread == self.current: # or not len(self.msg):
-            retVal = None
-        else:
-            MsgIndex = mesg_index(self.msg[0][0], lastread, self.current)
-            retVal = self.msg[MsgIndex:]
-        # End of critical section
+
+    def _endRead(self):
+        "Exit section of the reader"
         self.mutex1.acquire()
         self.readers = self.readers - 1
         if self.readers == 0: self.writeBlock.release()
         self.mutex1.release()
-        return retVal
 
-    def writer(self, data):
-        "Writer of readers and writers algorithm"
+    def _startWrite(self):
+        "Entry section of the writer"
         self.mutex2.acquire()
         self.writers = self.writers + 1
         if self.writers == 1: self.readBlock.acquire()
         self.mutex2.release()
         self.writeBlock.acquire()
-        # here is the critical section
-        self.current = self.cyclic_count.next()
-        self.msg.append((self.current, time.localtime(), data))
-        while len(self.msg) > MAX_LEN:
-            del self.msg[0]     # remove oldest item
-        # End of critical section
+
+    def _endWrite(self):
+        "Exit section of the writer"
         self.writeBlock.release()
         self.mutex2.acquire()
         self.writers = self.writers - 1
         if self.writers == 0: self.readBlock.release()
         self.mutex2.release()
 
-def sendAll(sock, lastread):
-    "Get any unread messages and send them to the client"
+    def reader(self, lastread, count=True):
+        """
+        Reader of readers and writers algorithm.  Returns None if there are no
+        new messages, else a tuple of the number of messages missed and a list
+        of the new messages.  If the reader has been lapped, the messages
+        start from the oldest one in the queue, and unless *count* is False
+        it is added to :attr:`lapped`.
+        """
+        self._startRead()
+        try:
+            # here is the critical section
+            if lastread == self.current or not self.msg:
+                retVal = None
+            else:
+                MsgIndex = mesg_index(self.msg[0].seq, lastread, self.current)
+                missed = 0
+                if MsgIndex == 0:
+                    missed = mesg_missed(self.msg[0].seq, lastread)
+                retVal = (missed, self.msg[MsgIndex:])
+            # End of critical section
+        finally:
+            self._endRead()
+        if count and retVal and retVal[0]:
+            self.lappedLock.acquire()
+            self.lapped += 1
+            self.lappedLock.release()
+        return retVal
+
+    def writer(self, data):
+        "Writer of readers and writers algorithm"
+        now = time.time()
+        text = formatMsg(time.localtime(now), data)
+        self._startWrite()
+        # here is the critical section
+        self.current = (self.current + 1) % MAX_INDEX
+        self.msg.append(Message(self.current, int(now), text))
+        self.nbytes += len(text)
+        while len(self.msg) > MAX_LEN or \
+              (self.nbytes > MAX_BYTES and len(self.msg) > 1):
+            self.nbytes -= len(self.msg[0].text)
+            del self.msg[0]     # remove oldest item
+        # End of critical section
+        self._endWrite()
+
+    def snapshot(self):
+        """
+        Return the contents of the queue and the current message index as a
+        picklable object, which :meth:`restore` can load into another queue.
+        """
+        self._startRead()
+        state = (self.current, list(self.msg))
+        self._endRead()
+        return state
+
+    def restore(self, state):
+        "Load the queue from the result of :meth:`snapshot`"
+        self._startWrite()
+        self.current, msgs = state
+        self.msg = [Message(*m) for m in msgs]
+        if len(self.msg) and isinstance(self.msg[0].stamp, time.struct_time):
+            # from a server that kept the time and the text apart
+            self.msg = [Message(m.seq, int(time.mktime(m.stamp)),
+                                formatMsg(m.stamp, m.text)) for m in self.msg]
+        self.nbytes = sum([len(m.text) for m in self.msg])
+        self._endWrite()
+
+def sendAll(client):
+    """
+    Get any unread messages and send them to the client.  The messages go in
+    the client's outbox, which sends large messages a chunk at a time between
+    the small ones.  New messages are only read from the queue once the small
+    messages already in the outbox are sent.  Clients that asked for it are
+    then sent ``/seq`` and the index of the last message, to /resume with.
+    Each call sends until about one chunk has gone out, or the socket will
+    not take any more.
+    """
     global chatQueue
-    reading = chatQueue.reader(lastread)
-    if reading == None: return lastread
-    for (last, timeStmp, msg) in reading:
-        sock.send("At %s -- %s" % (time.asctime(timeStmp), msg))
-        
-    return last
+    if not client.outbox.small and not client.multicast:
+        reading = chatQueue.reader(client.lastread)
+        if reading != None:
+            missed, reading = reading
+            if missed:
+                # Fell too far behind, skip ahead to the oldest message
+                client.outbox.add("*** %d messages missed ***\r\n" % missed)
+            for msg in reading:
+                client.outbox.add(msg.text)
+            client.lastread = msg.seq
+            client.msgsOut += len(reading)
+            if client.tellSeq:
+                client.outbox.add("/seq %d\n" % msg.seq, framed=True)
+    sent = 0
+    while sent < chunking.CHUNK_SIZE:
+        if not len(client.sending):
+            client.sending = client.outbox.next()
+            if client.sending is None:
+                client.sending = ''
+                return
+        began = time.time()
+        try:
+            n = client.sock.send(client.sending)
+        except socket.timeout:
+            client.sendBlocked += time.time() - began
+            return
+        client.sendBlocked += time.time() - began
+        client.sending = client.sending[n:]
+        client.bytesOut += n
+        sent += n
+
+class Presence(object):
+    """
+    Join and exit notices are kept here, in a separate lane from the chat
+    messages.  Every PRESENCE_WINDOW seconds the notices collected are written
+    to the chat queue as one digest message, such as "37 users joined".  When
+    lots of clients connect at once this keeps the notices from flooding every
+    client and pushing the chat messages out of the queue.
+    """
+    def __init__(self, queue):
+        self.queue = queue
+        self.lock = threading.Lock()
+        self.joined = []
+        self.exited = []
+
+    def join(self, msg):
+        "Note that a client has joined, msg is what to say if it is alone"
+        self.lock.acquire()
+        self.joined.append(msg)
+        self.lock.release()
+
+    def exit(self, msg):
+        "Note that a client has exited, msg is what to say if it is alone"
+        self.lock.acquire()
+        self.exited.append(msg)
+        self.lock.release()
+
+    def flush(self):
+        "Write a digest of the notices collected so far to the chat queue"
+        self.lock.acquire()
+        joined, self.joined = self.joined, []
+        exited, self.exited = self.exited, []
+        self.lock.release()
+        if len(joined) + len(exited) == 1:
+            # Just one, so say who it was
+            self.queue.writer((joined + exited)[0])
+        elif len(joined) + len(exited):
+            digest = []
+            if len(joined):
+                digest.append("%d users joined" % len(joined))
+            if len(exited):
+                digest.append("%d users exited" % len(exited))
+            self.queue.writer(", ".join(digest) + "\r\n")
+
+    def run(self):
+        "Thread that writes a digest at the end of each window"
+        while True:
+            time.sleep(PRESENCE_WINDOW)
+            self.flush()
+
+class ChatClient(object):
+    """
+    What the server knows about one connected client: the socket, the identity
+    of the user (peer) and the index of the last message sent to them.  This
+    is kept outside of the handlechild thread so that it can be passed to a
+    new server process by :mod:`handoff`.
+    """
+    def __init__(self, sock, peer, lastread=-1):
+        self.sock = sock
+        self.peer = peer
+        # lastreads of -1 gets all available messages on first read, even
+        # if message index cycled back to zero.
+        self.lastread = lastread
+        # messages read from the queue, but not yet sent
+        self.outbox = chunking.Outbox()
+        self.sending = ''              # what is left of the last send
+        # large messages from the client come in chunks
+        self.reassembler = chunking.Reassembler()
+        self.connid = None             # the id in the traffic capture
+        # gets the messages by multicast, rather than from sendAll
+        self.multicast = False
+        self.tellSeq = False           # send the index after the messages
+        self.announced = peer is not None  # others were told it joined
+        self.thread = None
+        # what the client has cost, see report()
+        self.bytesIn = self.msgsIn = 0
+        self.bytesOut = self.msgsOut = 0
+        self.sendBlocked = 0.0         # seconds spent in sock.send()
+
+    # What a new server process needs to carry on with the client
+    handed = ('peer', 'lastread', 'sending', 'outbox', 'reassembler',
+              'multicast', 'tellSeq', 'bytesIn', 'msgsIn', 'bytesOut', 'msgsOut',
+              'sendBlocked')
+
+clients = []                         # ChatClient of each connected client
+clientsLock = threading.Lock()
+# The TCP listening socket, and the Unix domain one if there is one (--unix)
+listenSocks = []
+unixIds = count(1)
+# Set when a new server process is taking over the connections.
+handingOff = threading.Event()
+stoppedAccepting = threading.Event()
+# Set when the server is stopped with control-C
+shuttingDown = threading.Event()
+# A capture.Capture when recording what the clients send (--capture)
+recorder = None
+# A multicast.Publisher when sending messages to a multicast group
+# (--multicast), and the index of the last message sent to it.
+publisher = None
+published = -1
+# Where the profiler writes the stacks it sampled (--profile), set by main
+profilePath = None
+# Nicknames of the users connected when the snapshot loaded at startup was
+# saved, who have not yet come back with /resume.
+resumable = set()
+
+def startClient(client):
+    "Start the thread that handles a client"
+    client.thread = threading.Thread(target = handlechild, args = [client])
+    client.thread.setDaemon(1)
+    client.thread.start()
+
+def addClient(client):
+    "Start a thread for a client and add it to the list of clients"
+    clientsLock.acquire()
+    clients.append(client)
+    clientsLock.release()
+    startClient(client)
+
+def removeClient(client):
+    "Remove a client that has disconnected from the list of clients"
+    clientsLock.acquire()
+    if client in clients:
+        clients.remove(client)
+    clientsLock.release()
 
 def clientExit(sock, peer, error=None):
     "Report that a client has exited the chat session."
     # this function just cuts down on some code duplication
-    global chatQueue
+    global presence
     print "A disconnect by " + peer
     if error:
         msg = peer + " has exited -- " + error + "\r\n"
     else:
         msg = peer + " has exited\r\n"
-    chatQueue.writer(msg)
+    presence.exit(msg)
+
+def resend(client, first, last):
+    """
+    Send messages *first* to *last* again to a multicast client, or tell it
+    the ones that are no longer in the queue.
+    """
+    global chatQueue
+    if chatQueue.current == -1:
+        return         # nothing has been written yet
+    # messages that are gone are not a lapped reader, so they are not counted
+    reading = chatQueue.reader((first - 1) % MAX_INDEX, count=False)
+    if reading == None: return
+    missed, reading = reading
+    if missed:
+        gone = (first + missed - 1) % MAX_INDEX
+        client.outbox.add("/gone %d %d\n" % (first, gone), framed=True)
+        if (last - first) % MAX_INDEX < missed:
+            return     # all of them are gone
+    for msg in reading:
+        client.outbox.add("/resend %d\n%s" % (msg.seq, msg.text), framed=True)
+        if msg.seq == last:
+            break
+
+def publish():
+    """
+    Thread that sends each new message in the queue to the multicast group
+    (--multicast), once for all of the multicast clients.
+    """
+    global chatQueue, published
+    if published == -1:
+        # Clients get what is already in the queue over TCP
+        published = chatQueue.current
+    lastSent = time.time()
+    while True:
+        reading = chatQueue.reader(published)
+        if reading == None:
+            if published != -1 and time.time() - lastSent > HEARTBEAT:
+                # so clients know if they missed the latest message
+                publisher.heartbeat(published)
+                lastSent = time.time()
+            time.sleep(PUBLISH_POLL)
+            continue
+        # Missed messages can be had with a NACK, just carry on
+        for msg in reading[1]:
+            publisher.publish(msg.seq, msg.text)
+        published = msg.seq
+        lastSent = time.time()
+
+def resumeAfter(seq):
+    """
+    The lastread for a client that got up to message seq before the server
+    restarted.  If the snapshot is older than that, the messages after it
+    were lost, so the client carries on from the latest one.
+    """
+    current = chatQueue.current
+    if current == -1:
+        return -1
+    if 0 < (seq - current) % MAX_INDEX < MAX_INDEX // 2:
+        return current
+    return seq
 
-def handlechild(clientsock):
+def process(client, data):
+    """
+    Process a message received from the client.  Returns False if the client
+    is leaving.
+    """
+    global chatQueue
+    # First check if it is a one of the special chat protocol messages.
+    if data.startswith('/nick'):
+        oldpeer = client.peer
+        client.peer = data.replace('/nick', '', 1).strip()
+        if len(client.peer):
+            chatQueue.writer("%s now goes by %s\r\n" \
+                            % (str(oldpeer), str(client.peer)))
+        else: client.peer = oldpeer
+
+    elif data.startswith('/quit'):
+        bye = data.replace('/quit', '', 1).strip()
+        if len(bye):
+            msg = "%s is leaving now -- %s\r\n" % (str(client.peer), bye)
+        else:
+            msg = "%s is leaving now\r\n" % (str(client.peer))
+        chatQueue.writer(msg)
+        return False
+
+    elif data.startswith('/multicast'):
+        # From now on the client gets the messages from the multicast group,
+        # tell it which message the group starts after.
+        if publisher:
+            client.multicast = True
+            client.outbox.add("/multicast %d %d\n" \
+                              % (client.lastread, MAX_INDEX), framed=True)
+
+    elif data.startswith('/nack'):
+        # A multicast client missed some messages, send them over TCP
+        if not (publisher and client.multicast):
+            return True
+        try:
+            first, last = [int(n) for n in data.split()[1:3]]
+        except ValueError:
+            return True
+        resend(client, first, last)
+
+    elif data.startswith('/resume'):
+        # Back after the server restarted, carry on after the last message
+        # this client got.  A user that was here before is not announced.
+        # Only the first message of a client may be /resume, so no one can
+        # take another user's name with it later.
+        if client.announced:
+            return True
+        client.announced = True
+        client.tellSeq = True
+        args = data.split(None, 2)[1:]
+        try:
+            client.lastread = resumeAfter(int(args[0]))
+        except (IndexError, ValueError):
+            pass
+        if len(args) > 1 and len(args[1].strip()):
+            client.peer = args[1].strip()
+        if client.peer in resumable:
+            resumable.discard(client.peer)
+        else:
+            presence.join(str(client.peer) + " has joined\r\n")
+
+    elif data.startswith('/seq'):
+        # The client wants to know the index of the messages it is sent,
+        # so it can /resume after a restart.
+        client.tellSeq = True
+        if client.lastread != -1:
+            client.outbox.add("/seq %d\n" % client.lastread, framed=True)
+    # elif data.startswith('/execute'):
+    #     data = data.replace('/execute', '', 1).strip()
+    #     chatQueue.writer(data)
+    else:
+        # Not a special command, but a chat message
+        chatQueue.writer("Message from %s:\r\n\t%s\r\n" \
+                            % (str(client.peer), data))
+    return True
+
+def handlechild(client):
     """
     The function that is ran as the thread to handle a client connection.
     It does the sending and receiving of data for one client
     """
-    global chatQueue
-    # lastreads of -1 gets all available messages on first read, even 
-    # if message index cycled back to zero.
-    lastread = -1
+    global presence
+    clientsock = client.sock
+    resuming = False
     # the identity of each user is called peer - they are the peer on the other
     # end of the socket connection. 
-    peer = clientsock.getpeername()
-    print "Got connection from ", peer
-    msg = str(peer) + " has joined\r\n"
-    chatQueue.writer(msg)
+    if client.peer is None:
+        if clientsock.family == socket.AF_UNIX:
+            # unix socket clients have no address, so number them
+            client.peer = ('unix', unixIds.next())
+        else:
+            client.peer = clientsock.getpeername()
+        print "Got connection from ", client.peer
+        # A client coming back after a restart sends /resume first.  Give it
+        # a moment to arrive, so the client is not sent again what it has
+        # seen and is not announced as someone new.
+        try:
+            if select.select([clientsock], [], [], RESUME_WAIT)[0]:
+                first = clientsock.recv(chunking.MAX_HEADER + 7,
+                                        socket.MSG_PEEK)
+                if first.startswith(chunking.MARK):
+                    first = first.split('\n', 1)[-1]
+                resuming = first.startswith('/resume')
+        except socket.error:
+            pass
+        if not resuming:
+            client.announced = True
+            msg = str(client.peer) + " has joined\r\n"
+            presence.join(msg)
+    if recorder:
+        client.connid = recorder.connection(time.time())
     while 1:
-        # check for and send any new messages
-        lastread = sendAll(clientsock, lastread)
+        if handingOff.isSet():
+            # Leave the socket open, a new server process is taking it over.
+            return
+        # check for and send any new messages, once /resume is read
+        if resuming:
+            resuming = False
+        else:
+            try:
+                sendAll(client)
+            except socket.error, e:
+                if shuttingDown.isSet():
+                    return
+                print "Send to %s failed: %s" % (str(client.peer), e)
+                clientExit(clientsock, str(client.peer))
+                break
+        if len(client.sending) or len(client.outbox):
+            # More to send, so don't wait for the client unless it sent
+            # something.
+            if not select.select([clientsock], [], [], 0)[0]:
+                continue
         try:
             data = clientsock.recv(4096)
         except socket.timeout:
             continue
         except socket.error:
-            # caused by main thread doing a socket.close on this socket
-            # It is a race condition if this exception is raised or not.
-            print "Server shutdown"
-            return
-        except:  # some error or connection reset by peer
-            clientExit(clientsock, str(peer))
+            if shuttingDown.isSet():
+                # caused by main thread doing a socket.close on this socket
+                # It is a race condition if this exception is raised or not.
+                print "Server shutdown"
+                return
+            # connection reset by peer
+            clientExit(clientsock, str(client.peer))
+            break
+        except:  # some other error
+            clientExit(clientsock, str(client.peer))
             break
         if not len(data): # a disconnect (socket.close() by client)
-            clientExit(clientsock, str(peer))
+            clientExit(clientsock, str(client.peer))
             break
-
-        # Process the message received from the client
-        # First check if it is a one of the special chat protocol messages.
-        if data.startswith('/nick'):
-            oldpeer = peer
-            peer = data.replace('/nick', '', 1).strip()
-            if len(peer):
-                chatQueue.writer("%s now goes by %s\r\n" \
-                                % (str(oldpeer), str(peer)))
-            else: peer = oldpeer
-
-        elif data.startswith('/quit'):
-            bye = data.replace('/quit', '', 1).strip()
-            if len(bye):
-                msg = "%s is leaving now -- %s\r\n" % (str(peer), bye)
-            else:
-                msg = "%s is leaving now\r\n" % (str(peer))
-            chatQueue.writer(msg)
+        if recorder:
+            recorder.data(time.time(), client.connid, data)
+        client.bytesIn += len(data)
+        # Large messages arrive a chunk at a time, only process
+        # what is complete.
+        try:
+            pieces = client.reassembler.feed(data)
+        except chunking.Overflow, e:
+            print "Dropping %s: %s" % (str(client.peer), e)
+            clientExit(clientsock, str(client.peer))
+            break
+        quitting = False
+        for data in pieces:
+            client.msgsIn += 1
+            if not process(client, data):
+                quitting = True
+                break
+        if quitting:
             break            # exit the loop to disconnect
-        # elif data.startswith('/execute'):
-        #     data = data.replace('/execute', '', 1).strip()
-        #     chatQueue.writer(data)
-        else:
-            # Not a special command, but a chat message
-            chatQueue.writer("Message from %s:\r\n\t%s\r\n" \
-                                % (str(peer), data))
 
     #-- End looping for messages from/to the client
     # Close the connection
+    if recorder:
+        recorder.closed(time.time(), client.connid)
+    removeClient(client)
     clientsock.close()
 
+def handover():
+    """
+    Called by :func:`handoff.offer` when a new server process wants to take
+    over.  Stop accepting connections and stop all of the client threads, then
+    return the sockets and the state of the chat room for the new process.
+    """
+    global chatQueue, presence
+    handingOff.set()
+    stoppedAccepting.wait()
+    clientsLock.acquire()
+    threads = [client.thread for client in clients]
+    clientsLock.release()
+    for t in threads:
+        t.join()
+    presence.flush()
+    # Clients that quit in the mean time have removed themselves.
+    handed = list(clients)
+    sockets = listenSocks + [client.sock for client in handed]
+    state = {
+        'listeners': len(listenSocks),
+        'queue': chatQueue.snapshot(),
+        'clients': [dict([(name, getattr(client, name))
+                          for name in ChatClient.handed])
+                    for client in handed],
+        'published': published,
+    }
+    print "Handing %d clients over to the new server" % len(handed)
+    return sockets, state
+
+def takeover(path):
+    """
+    Take the listening sockets, the clients and the message queue over from
+    a server that is already running.  Returns the listening sockets, or
+    None if there was no server to take over from.
+    """
+    global chatQueue, published, unixIds
+    received = handoff.receive(path)
+    if received is None:
+        return None
+    sockets, state = received
+    chatQueue.restore(state['queue'])
+    published = state['published']
+    listeners = state.get('listeners', 1)
+    # go on numbering the unix socket clients after those handed over
+    unixIds = count(max([0] + [c['peer'][1] for c in state['clients']
+                              if c['peer'][0] == 'unix']) + 1)
+    for sock, clientState in zip(sockets[listeners:], state['clients']):
+        sock.settimeout(1)
+        client = ChatClient(sock, None)
+        for name, value in clientState.items():
+            setattr(client, name, value)
+        client.announced = True
+        addClient(client)
+    print "Took over %d clients from the old server" % len(state['clients'])
+    return sockets[:listeners]
+
+def memoryUsage():
+    """
+    Return the number of messages and bytes held by the message queue and the
+    number of bytes waiting in the clients' buffers.
+    """
+    global chatQueue
+    # Called from the SIGUSR1 handler, which runs on the main thread, so
+    # clientsLock may already be held (by addClient) and must not be taken.
+    # Copying the list is atomic.
+    buffered = sum([len(client.sending) + client.outbox.nbytes +
+                    client.reassembler.nbytes for client in list(clients)])
+    return len(chatQueue.msg), chatQueue.nbytes, buffered
+
+def unread(client):
+    "The number of messages in the queue not yet read for a client"
+    if client.lastread == -1:
+        return len(chatQueue.msg)
+    return (chatQueue.current - client.lastread) % MAX_INDEX
+
+def slowClients(n=REPORT_TOP):
+    """
+    Return the n clients that have spent the longest blocked in send, with
+    the most unread messages first among equals.
+    """
+    slow = list(clients)           # without clientsLock, see memoryUsage()
+    slow.sort(key=lambda c: (c.sendBlocked, unread(c)), reverse=True)
+    return slow[:n]
+
+def report(signum=None, frame=None):
+    "Print the state of the server, the SIGUSR1 handler"
+    queued, nbytes, buffered = memoryUsage()
+    print "Message queue: %d messages, %d of %d bytes" \
+            % (queued, nbytes, MAX_BYTES)
+    print "Client buffers: %d clients, %d bytes" % (len(clients), buffered)
+    print "Total: %d bytes" % (nbytes + buffered)
+    print "Readers lapped: %d" % chatQueue.lapped
+    slow = slowClients()
+    if not slow:
+        return
+    print "Slowest clients:"
+    print "  %-28s %10s %7s %10s %7s %9s %7s %9s" % ('peer', 'bytes in',
+            'msgs', 'bytes out', 'msgs', 'blocked', 'unread', 'buffered')
+    for client in slow:
+        if client.multicast:
+            lag = '-'          # sent by multicast, not from the queue
+        else:
+            lag = str(unread(client))
+        print "  %-28s %10d %7d %10d %7d %8.2fs %7s %9d" % (
+                str(client.peer)[:28], client.bytesIn, client.msgsIn,
+                client.bytesOut, client.msgsOut, client.sendBlocked, lag,
+                len(client.sending) + client.outbox.nbytes)
+
+def toggleProfile(signum=None, frame=None):
+    """
+    Start or stop the profiler, the SIGUSR2 handler.  When it stops, the
+    stacks sampled are written to profilePath and the lock timings printed.
+    """
+    sys.stdout.write(profiler.toggle(profilePath))
+
+def saveSnapshot(path):
+    "Save the messages and the nicknames of the users to path"
+    clientsLock.acquire()
+    nicks = [client.peer for client in clients
+             if isinstance(client.peer, str)]
+    clientsLock.release()
+    snapshot.save(path, {'queue': chatQueue.snapshot(), 'nicks': nicks})
+
+def saveSnapshots(path):
+    "Thread that saves a snapshot every so often, if there is a new message"
+    saved = chatQueue.current
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        if chatQueue.current != saved:
+            saved = chatQueue.current
+            saveSnapshot(path)
+
+def loadSnapshot(path):
+    "Start from the snapshot saved in path by an earlier server, if any"
+    began = time.time()
+    state = snapshot.load(path)
+    if state is None:
+        return
+    chatQueue.restore(state['queue'])
+    resumable.update(state['nicks'])
+    print "Loaded %d messages and %d users from %s in %.3f seconds" \
+            % (len(chatQueue.msg), len(resumable), path, time.time() - began)
+
+def carryOn():
+    "Go back to serving the clients after a handoff failed"
+    stoppedAccepting.clear()
+    handingOff.clear()
+    clientsLock.acquire()
+    handed = list(clients)
+    clientsLock.release()
+    for client in handed:
+        startClient(client)
+
+def waitForSuccessor(path):
+    "A thread that waits to hand the server over to a new process"
+    while True:
+        if handoff.offer(path, handover):
+            if recorder:
+                recorder.close()
+            # Exit without closing the sockets, they now belong to the new
+            # process
+            os._exit(0)
+        print "The new server failed to take over, carrying on"
+        carryOn()
+
 # Begin the main part of the program
-def main():
+def main(handoffPath, takeOver=False, unixPath=None, snapshotPath=None):
     """
     The parent thread that listens for connections and spawns a child thread
-    to handle each connection.
+    to handle each connection.  Local clients may also connect to the Unix
+    domain socket at *unixPath*.  With a *snapshotPath*, the state of the
+    room is saved there and loaded again when the server is restarted.
     """
-    global chatQueue
-    clients = []
+    global listenSocks
+    signal.signal(signal.SIGUSR1, report)
+    signal.signal(signal.SIGUSR2, toggleProfile)
 
-    # Set up the socket.
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind((host, port))
-    s.listen(3)
+    socks = None
+    if takeOver:
+        socks = takeover(handoffPath)
+    if socks is None:
+        if snapshotPath:
+            loadSnapshot(snapshotPath)
+        # Set up the socket.
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, port))
+        s.listen(3)
+        socks = [s]
+    if unixPath and socket.AF_UNIX not in [s.family for s in socks]:
+        if os.path.exists(unixPath):
+            os.unlink(unixPath)        # left by a server that died
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(unixPath)
+        s.listen(3)
+        socks.append(s)
+    for s in socks:
+        # in case a client goes away between select() and accept()
+        s.settimeout(1)
+    listenSocks = socks
+    if publisher:
+        t = threading.Thread(target = publish)
+        t.setDaemon(1)
+        t.start()
+    t = threading.Thread(target = presence.run)
+    t.setDaemon(1)
+    t.start()
+    t = threading.Thread(target = waitForSuccessor, args = [handoffPath])
+    t.setDaemon(1)
+    t.start()
+    if snapshotPath:
+        t = threading.Thread(target = saveSnapshots, args = [snapshotPath])
+        t.setDaemon(1)
+        t.start()
 
-    while 1:
-        print "Waiting for Connections"
+    print "Waiting for Connections"
+    while True:
+        if handingOff.isSet():
+            # A new server is taking over.  The handoff thread exits the
+            # process, or clears handingOff if the new server failed.
+            stoppedAccepting.set()
+            while handingOff.isSet():
+                time.sleep(0.1)
+            print "Waiting for Connections"
+            continue
         try:
-            clientsock, clientaddr = s.accept()
+            # time out once in a while to check if a new server is taking over
+            ready = select.select(listenSocks, [], [], 1)[0]
+            if not ready:
+                continue
+            clientsock, clientaddr = ready[0].accept()
             # set a timeout so it won't block forever on socket.recv().
             # Clients that are not doing anything check for new messages 
             # after each timeout.
             clientsock.settimeout(1)
+            # Keep the kernel from queueing up much more than a chunk, so
+            # that messages can go out between the chunks of a large one.
+            clientsock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                  SEND_BUFFER)
+        except socket.timeout:
+            continue
+        except (socket.error, select.error), e:
+            if e.args[0] == errno.EINTR:    # interrupted by a signal
+                continue
+            raise
         except KeyboardInterrupt:
+            shuttingDown.set()
+            if snapshotPath:
+                # while the clients are still here, to save their nicknames
+                presence.flush()
+                saveSnapshot(snapshotPath)
             # shutdown - force the threads to close by closing their socket
-            s.close()
-            for sock in clients:
-                sock.close()
-            break
+            for s in listenSocks:
+                s.close()
+            if unixPath and os.path.exists(unixPath):
+                os.unlink(unixPath)
+            clientsLock.acquire()
+            for client in clients:
+                client.sock.close()
+            clientsLock.release()
+            if recorder:
+                recorder.close()
+            return
         #except:
         #    traceback.print_exc()
         #    continue
 
-        clients.append(clientsock)
-        t = threading.Thread(target = handlechild, args = [clientsock])
-        t.setDaemon(1)
-        t.start()
+        addClient(ChatClient(clientsock, None))
+        print "Waiting for Connections"
 
 if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--takeover', action='store_true', default=False,
+                      help='take the connections over from a running server')
+    parser.add_option('--handoff', default=handoff.default_path('chat.sock'),
+                      metavar='PATH',
+                      help='Unix socket used to hand over to a new server '
+                           '[default: %default]')
+    parser.add_option('--unix', metavar='PATH',
+                      help='also listen on a Unix domain socket at PATH, for '
+                           'clients on this host')
+    parser.add_option('--snapshot', metavar='FILE',
+                      help='save the messages in FILE every %d seconds, and '
+                           'load them from it when started' % SNAPSHOT_INTERVAL)
+    parser.add_option('--capture', metavar='FILE',
+                      help='record the traffic from the clients in FILE, '
+                           'for replay.py')
+    parser.add_option('--multicast', metavar='GROUP:PORT',
+                      help='also send the messages to a UDP multicast group, '
+                           'for clients on the LAN (e.g. %s:%d)' \
+                           % (multicast.GROUP, multicast.PORT))
+    parser.add_option('--multicast-if', default='0.0.0.0', metavar='ADDRESS',
+                      help='interface to send multicast on, 127.0.0.1 for '
+                           'testing [default: %default]')
+    parser.add_option('--profile', metavar='FILE',
+                      default=handoff.default_path('profile.folded'),
+                      help='where SIGUSR2 writes the stacks it sampled, for '
+                           'flamegraph.pl [default: %default]')
+    options, args = parser.parse_args()
+    profilePath = options.profile
+    if options.capture:
+        recorder = capture.Capture(options.capture)
+    if options.multicast:
+        group, mport = options.multicast.split(':')
+        publisher = multicast.Publisher(group, int(mport),
+                                        options.multicast_if)
     # One global message queue, which uses the readers and writers
     # synchronization algorithm.
     chatQueue = MSGQueue()
-    main()
+    # Join and exit notices are collected and written to the queue as digests
+    presence = Presence(chatQueue)
+    main(options.handoff, options.takeover, options.unix, options.snapshot)
@@ -0,0 +1,179 @@
+"""
+**File:** chunking.py
+
+Send large messages in chunks, so that they do not hold up the small chat
+messages sent over the same connection.
+
+A message longer than CHUNK_SIZE is sent as a series of chunk frames.  Each
+frame starts with a header line: the MARK character, the message id (in
+hex), 1 if it is the last chunk or else 0, and the length of the data that
+follows the header::
+
+    \\x1e1f 0 16384\\n<16384 bytes of data>
+
+The server sends small messages just as they are, without a header, so that
+the protocol stays plain text.  Clients frame every message they send, since
+the server reads what arrives a few KB at a time and a message split across
+two reads would otherwise come out as two.  The :class:`Outbox` of a
+connection takes turns between its messages, sending a small message whole
+and one chunk of a large one at a time.  On the other end a
+:class:`Reassembler` puts the chunks back together as they arrive.  It holds at most MAX_HELD bytes of MAX_OPEN
+unfinished messages, and raises :class:`Overflow` if the sender goes over, so
+that one connection can not use up the memory of the server.
+"""
+
+from collections import deque
+from itertools import count
+
+CHUNK_SIZE = 16 * 1024
+MARK = '\x1e'                # ASCII record separator, not found in chat text
+MAX_HEADER = 64              # longer than any valid header
+MAX_HELD = 8 * 1024 * 1024   # most bytes of unfinished messages held
+MAX_OPEN = 8                 # most unfinished messages at once
+
+class Overflow(Exception):
+    "Raised when a sender has too much of its messages unfinished"
+
+def frames(msgid, data):
+    "Generator of the chunk frames for a large message"
+    for start in range(0, len(data), CHUNK_SIZE):
+        piece = data[start:start + CHUNK_SIZE]
+        last = start + CHUNK_SIZE >= len(data)
+        yield "%s%x %d %d\n%s" % (MARK, msgid, last, len(piece), piece)
+
+class Outbox(object):
+    """
+    The messages waiting to be sent on one connection.  Small messages are
+    sent whole, in order.  Large messages are sent a chunk at a time, taking
+    turns with each other and with the small messages.
+    """
+    def __init__(self):
+        self.pending = deque()   # strings, or generators of chunk frames
+        self.ids = count()
+        self.nbytes = 0          # bytes not yet taken by next()
+        self.small = 0           # small messages in pending
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, data, framed=False):
+        """
+        Add a message to send.  A small message may be *framed* too, so that
+        it arrives on its own rather than run together with the text around
+        it (for control messages).
+        """
+        if len(data) <= CHUNK_SIZE and not framed:
+            self.pending.append(data)
+            self.small += 1
+        else:
+            self.pending.append(frames(self.ids.next(), data))
+        self.nbytes += len(data)
+
+    def __getstate__(self):
+        # Generators can not be pickled (for a handoff), so take everything
+        # left to send out of the outbox and put it in one list.
+        left = []
+        while True:
+            frame = self.next()
+            if frame is None:
+                break
+            left.append(frame)
+        state = {'frames': left, 'id': self.ids.next()}
+        # keep them here too, in case the handoff fails
+        self.__setstate__(state)
+        return state
+
+    def __setstate__(self, state):
+        self.pending = deque(state['frames'])
+        self.ids = count(state['id'])
+        self.nbytes = sum([len(f) for f in state['frames']])
+        self.small = len(state['frames'])
+
+    def next(self):
+        "Return the next message or chunk frame to send, or None"
+        while len(self.pending):
+            item = self.pending.popleft()
+            if isinstance(item, str):
+                self.small -= 1
+                self.nbytes -= len(item)
+                return item
+            try:
+                frame = item.next()
+            except StopIteration:
+                continue
+            # back of the line for the rest of this message
+            self.pending.append(item)
+            self.nbytes -= len(frame) - frame.index('\n') - 1
+            return frame
+        return None
+
+class Reassembler(object):
+    """
+    Takes the data received on a connection, which may have chunk frames
+    mixed in with plain text, and gives back the plain text and the complete
+    large messages.
+    """
+    def __init__(self):
+        self.buf = ''            # an incomplete header
+        self.msgid = None        # the message of the frame being read
+        self.last = False
+        self.need = 0            # bytes of the frame still to come
+        self.parts = {}          # the chunks so far of each large message
+        self.nbytes = 0          # bytes held in parts
+
+    def feed(self, data):
+        """
+        Return a list of the text and the messages completed by data.  Raises
+        :class:`Overflow` if the sender has too much unfinished.
+        """
+        done = []
+        data = self.buf + data
+        self.buf = ''
+        while len(data):
+            if self.need:
+                piece = data[:self.need]
+                data = data[self.need:]
+                self.need -= len(piece)
+                self.parts[self.msgid].append(piece)
+                self.nbytes += len(piece)
+                if not self.need and self.last:
+                    msg = ''.join(self.parts.pop(self.msgid))
+                    self.nbytes -= len(msg)
+                    done.append(msg)
+                continue
+            start = data.find(MARK)
+            if start == -1:
+                done.append(data)
+                break
+            if start > 0:
+                done.append(data[:start])
+                data = data[start:]
+            end = data.find('\n', 0, MAX_HEADER)
+            if end == -1 and len(data) < MAX_HEADER:
+                self.buf = data   # wait for the rest of the header
+                break
+            try:
+                if end == -1:
+                    raise ValueError("header too long")
+                msgid, last, size = data[1:end].split()
+                msgid, size = int(msgid, 16), int(size)
+                if not 0 <= size <= CHUNK_SIZE:
+                    raise ValueError("bad chunk size")
+            except ValueError:
+                # Not a header after all, pass the mark on as text
+                done.append(data[0])
+                data = data[1:]
+                continue
+            self.msgid, self.last, self.need = msgid, last == '1', size
+            if msgid not in self.parts:
+                if len(self.parts) >= MAX_OPEN:
+                    raise Overflow("more than %d unfinished messages"
+                                   % MAX_OPEN)
+                self.parts[msgid] = []
+            if self.nbytes + size > MAX_HELD:
+                raise Overflow("more than %d bytes of unfinished messages"
+                               % MAX_HELD)
+            data = data[end + 1:]
+            if not self.need and self.last:
+                done.append(''.join(self.parts.pop(self.msgid)))
+        return done
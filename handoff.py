@@ -0,0 +1,135 @@
+"""
+**File:** handoff.py
+
+Hand the sockets of a running chat server over to a new server process so
+that the server can be restarted without dropping any client connections.
+
+The running server calls :func:`offer` in a background thread.  It waits on a
+Unix domain socket for a successor to connect.  A new server process started
+with ``--takeover`` calls :func:`receive`, which connects to that Unix socket
+and is given the listening socket, every live client socket and whatever
+state the old server wants to pass along (nick names, last-read sequence
+numbers, the message queue ...).  The file descriptors themselves are passed
+with SCM_RIGHTS, so the TCP connections never close and the clients never
+notice that the process on the other end has changed.
+
+Only a process of the same user may take over, or be taken over from.  Both
+ends check the user of the other with SO_PEERCRED, and the successor has to
+send GREETING before the running server stops for it.  The default paths are
+in a directory of the user's that no one else may use (see
+:func:`default_path`).
+"""
+
+import os
+import errno
+import stat
+import socket
+import struct
+import tempfile
+from multiprocessing.connection import Listener, Client
+from multiprocessing import reduction
+
+GREETING = 'eyesome-takeover-1'
+GREETING_WAIT = 5            # seconds a successor has to send GREETING
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)    # missing in Python 2
+
+def default_path(name):
+    """
+    The path of a file called *name* (a handoff socket, say), in a directory
+    of the temp directory that only this user may use.  Raises OSError if the
+    directory is there but belongs to someone else or others may use it.
+    """
+    directory = os.path.join(tempfile.gettempdir(), 'eyesome-%d' % os.getuid())
+    try:
+        os.mkdir(directory, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or \
+       info.st_mode & 077:
+        raise OSError("%s is not a private directory" % directory)
+    return os.path.join(directory, name)
+
+def _same_user(conn):
+    "True if the process on the other end of conn is run by this user"
+    sock = socket.fromfd(conn.fileno(), socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        creds = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                struct.calcsize('3i'))
+    finally:
+        sock.close()           # fromfd made a duplicate
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid == os.getuid()
+
+def _greeted(conn):
+    "True if a successor sent GREETING in time"
+    try:
+        return conn.poll(GREETING_WAIT) and \
+               conn.recv_bytes(len(GREETING)) == GREETING
+    except (IOError, EOFError):
+        return False
+
+def offer(path, handover):
+    """
+    :param path: file name of the Unix domain socket to wait on
+    :param handover: function called once a successor has connected.  It must
+        stop all network activity and return a tuple ``(sockets, state)`` where
+        *sockets* is a list of socket objects to pass and *state* is any
+        picklable object.
+
+    Blocks until a successor process of the same user connects and greets,
+    then passes the sockets and the state to it.  Returns True once the
+    successor has confirmed that it has everything, after which the caller
+    should exit without closing (or shutting down) the sockets.  Returns
+    False if the successor went away before that, and the caller should
+    carry on with the sockets itself.
+    """
+    if os.path.exists(path):
+        os.unlink(path)        # left over from a server that crashed
+    listener = Listener(path, 'AF_UNIX')
+    while True:
+        conn = listener.accept()
+        if _same_user(conn) and _greeted(conn):
+            break
+        print "Ignoring a connection to %s, it is not a successor" % path
+        conn.close()
+    # Close now, so that the successor may bind the same path for the
+    # next restart.
+    listener.close()
+    sockets, state = handover()
+    try:
+        conn.send((state, [(s.family, s.type) for s in sockets]))
+        for s in sockets:
+            reduction.send_handle(conn, s.fileno(), None)
+        done = conn.recv()
+    except (EnvironmentError, EOFError):
+        done = False
+    conn.close()
+    return done
+
+def receive(path):
+    """
+    :param path: file name of the Unix domain socket of the running server
+
+    Take over from a running server.  Returns ``(sockets, state)`` as given
+    to :func:`offer` by the old server, or None if there is no server
+    to take over from.
+    """
+    try:
+        conn = Client(path, 'AF_UNIX')
+    except socket.error:
+        return None
+    if not _same_user(conn):
+        conn.close()
+        raise OSError("%s belongs to another user" % path)
+    conn.send_bytes(GREETING)
+    state, kinds = conn.recv()
+    sockets = []
+    for family, type in kinds:
+        fd = reduction.recv_handle(conn)
+        sockets.append(socket.fromfd(fd, family, type))
+        os.close(fd)           # fromfd made a duplicate
+    conn.send(True)
+    conn.close()
+    return sockets, state
@@ -0,0 +1,203 @@
+"""
+**File:** multicast.py
+
+UDP multicast fan-out for clients on the same LAN as the chat server.
+
+Instead of sending each message over the TCP connection of every client, the
+server publishes it once to a multicast group.  Each datagram is a header
+line, the sequence number of the message and 1 if the message follows (or
+0 if it was too big for a datagram), and then the message::
+
+    1234 1\\n<message>
+
+UDP may lose or reorder datagrams, so the client keeps them in order with a
+:class:`Sequencer`.  When a sequence number is skipped, the client asks for
+the missing messages over its TCP connection with ``/nack first last``.  The
+server replies on the TCP connection with ``/resend seq`` for each message it
+still has, and ``/gone first last`` for those it no longer has.  So that the
+loss of the last message is noticed too, while there is nothing new the
+server sends the number of the latest message once in a while as a
+heartbeat, in a datagram without the message.
+
+Loopback works for testing: give 127.0.0.1 as the interface on both ends.
+"""
+
+import socket
+import struct
+
+GROUP = '239.255.50.50'
+PORT = 50001
+MAX_DATAGRAM = 1400          # fits in one Ethernet frame
+
+def _membership(group, interface):
+    return struct.pack('4s4s', socket.inet_aton(group),
+                       socket.inet_aton(interface))
+
+def parse(datagram):
+    """
+    Return the sequence number and the message (None if not included).
+    Raises ValueError if the datagram is not one sent by a Publisher.
+    """
+    header, data = datagram.split('\n', 1)
+    seq, included = header.split()
+    if int(seq) < 0 or included not in ('0', '1'):
+        raise ValueError("not a chat datagram")
+    if included == '1':
+        return int(seq), data
+    return int(seq), None
+
+class Publisher(object):
+    "The server end, which sends each message once to the group"
+    def __init__(self, group=GROUP, port=PORT, interface='0.0.0.0', ttl=1):
+        self.address = (group, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                             socket.inet_aton(interface))
+
+    def publish(self, seq, data):
+        "Send a message to the group, or just its number if it is too big"
+        if len(data) <= MAX_DATAGRAM:
+            self.sock.sendto("%d 1\n%s" % (seq, data), self.address)
+        else:
+            self.heartbeat(seq)
+
+    def heartbeat(self, seq):
+        "Send just the number of the latest message"
+        self.sock.sendto("%d 0\n" % seq, self.address)
+
+class Subscriber(object):
+    "The client end, which receives the datagrams sent to the group"
+    def __init__(self, group=GROUP, port=PORT, interface='0.0.0.0'):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', port))
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                             _membership(group, interface))
+
+    def fileno(self):
+        "So that a Subscriber can be given to select()"
+        return self.sock.fileno()
+
+    def receive(self):
+        "Return the sequence number and message of the next datagram"
+        return parse(self.sock.recv(65536))
+
+    def close(self):
+        self.sock.close()
+
+# Marks a message the server no longer has
+GONE = object()
+
+class Sequencer(object):
+    """
+    Puts the messages from the datagrams, and those sent again over TCP, back
+    in order.  Each method returns a list of the messages that are now ready
+    to display.  Those that add a datagram also return the first and last
+    sequence numbers to ask the server for, or None.
+
+    The sequence numbers count up to *modulus* and then start again at zero.
+    Datagrams that arrive before :meth:`start` are held until it is called.
+    """
+    def __init__(self):
+        self.expected = None       # the next sequence number to display
+        self.modulus = None
+        self.early = []
+        self.held = {}             # sequence number: message
+        self.askedTo = None        # the last sequence number asked for
+
+    def _ahead(self, seq):
+        "How far ahead of the next one to display seq is, -1 if behind"
+        ahead = (seq - self.expected) % self.modulus
+        if ahead >= self.modulus // 2:
+            return -1
+        return ahead
+
+    def _ask(self, upto):
+        "The range up to seq not yet asked for, or None"
+        first = self.expected
+        if self.askedTo is not None and self._ahead(self.askedTo) >= 0:
+            if self._ahead(self.askedTo) >= self._ahead(upto):
+                return None
+            first = (self.askedTo + 1) % self.modulus
+        self.askedTo = upto
+        # no need to ask for those already here
+        while first in self.held and first != upto:
+            first = (first + 1) % self.modulus
+        if first in self.held:
+            return None
+        return (first, upto)
+
+    def _release(self):
+        "The messages that are ready, in order"
+        ready = []
+        missed = 0
+        while self.expected in self.held:
+            msg = self.held.pop(self.expected)
+            if msg is GONE:
+                missed += 1
+            else:
+                if missed:
+                    ready.append("*** %d messages missed ***\r\n" % missed)
+                    missed = 0
+                ready.append(msg)
+            self.expected = (self.expected + 1) % self.modulus
+        if missed:
+            ready.append("*** %d messages missed ***\r\n" % missed)
+        return ready
+
+    def start(self, last, modulus):
+        """
+        Begin after message number *last*, which the server sent over TCP.
+        """
+        self.expected = (last + 1) % modulus
+        self.modulus = modulus
+        ready = []
+        nack = None
+        for seq, data in self.early:
+            more, ask = self.datagram(seq, data)
+            ready.extend(more)
+            nack = ask or nack
+        self.early = []
+        if nack:
+            nack = (self.expected, nack[1])
+        return ready, nack
+
+    def datagram(self, seq, data):
+        "A datagram from the group, data is None if it held no message"
+        if self.expected is None:
+            self.early.append((seq, data))
+            return [], None
+        if seq >= self.modulus:
+            return [], None        # not a number the server would use
+        ahead = self._ahead(seq)
+        if ahead < 0:
+            return [], None        # a message already displayed
+        if data is None:
+            return self._release(), self._ask(seq)
+        self.held[seq] = data
+        nack = None
+        if ahead > 0:
+            nack = self._ask((seq - 1) % self.modulus)
+        return self._release(), nack
+
+    def resent(self, seq, data):
+        "A message sent again by the server"
+        if self.expected is not None and self._ahead(seq) >= 0:
+            self.held[seq] = data
+            return self._release()
+        return []
+
+    def gone(self, first, last):
+        "Messages the server no longer has"
+        if self.expected is None:
+            return []
+        seq = first
+        while True:
+            if self._ahead(seq) >= 0:
+                self.held[seq] = GONE
+            if seq == last:
+                break
+            seq = (seq + 1) % self.modulus
+        return self._release()
@@ -0,0 +1,159 @@
+"""
+**File:** profiler.py
+
+Find out where the chat server spends its time when it slows down under load.
+Profiling is off until :func:`toggle` is called (chatserverStub does so on
+SIGUSR2), and calling it again turns it off and writes out the results.
+
+While on:
+
+* A sampler thread looks at the stack of every other thread SAMPLE_RATE times
+  a second.  The stacks are written in the collapsed format used by
+  flamegraph.pl, one line for each stack with the number of times it was
+  seen.
+
+* Each :class:`TracedLock` keeps a histogram of how long threads waited to
+  acquire it and how long it was held.  The buckets are powers of two
+  micro-seconds.  When profiling is off, a TracedLock only costs a test of a
+  flag on each acquire.
+"""
+
+import os
+import sys
+import threading
+import time
+import weakref
+
+SAMPLE_RATE = 100            # stack samples a second
+BUCKETS = 24                 # the last is for 2**23 us (8 seconds) or more
+
+tracing = False              # True while the locks record their timings
+locks = weakref.WeakValueDictionary()    # the TracedLocks, by id
+sampler = None
+
+def _bucket(seconds):
+    "The histogram bucket for a time, bucket n is for up to 2**n micro-seconds"
+    us = int(seconds * 1e6)
+    n = 0
+    while us and n < BUCKETS - 1:
+        us >>= 1
+        n += 1
+    return n
+
+class TracedLock(object):
+    """
+    A threading.Lock that can record how long it is waited for and held.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.acquired = None
+        self.waits = [0] * BUCKETS
+        self.holds = [0] * BUCKETS
+        locks[id(self)] = self
+
+    def acquire(self, blocking=1):
+        if not tracing:
+            return self.lock.acquire(blocking)
+        start = time.time()
+        got = self.lock.acquire(blocking)
+        if got:
+            # the lock is held, so no one else is changing the histograms
+            self.acquired = time.time()
+            self.waits[_bucket(self.acquired - start)] += 1
+        return got
+
+    def release(self):
+        if self.acquired is not None:
+            self.holds[_bucket(time.time() - self.acquired)] += 1
+            self.acquired = None
+        self.lock.release()
+
+    def reset(self):
+        self.waits = [0] * BUCKETS
+        self.holds = [0] * BUCKETS
+
+class Sampler(threading.Thread):
+    "Counts the stacks of all of the other threads"
+    def __init__(self, rate=SAMPLE_RATE):
+        threading.Thread.__init__(self)
+        self.setDaemon(1)
+        self.interval = 1.0 / rate
+        self.stacks = {}
+        self.done = threading.Event()
+
+    def run(self):
+        me = threading.currentThread().ident
+        while not self.done.isSet():
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s:%s" % (os.path.basename(code.co_filename),
+                                            code.co_name))
+                    frame = frame.f_back
+                stack.reverse()
+                key = ';'.join(stack)
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.done.wait(self.interval)
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+    def write(self, path):
+        "Write the stacks in the collapsed format of flamegraph.pl"
+        f = open(path, 'w')
+        for stack, n in sorted(self.stacks.items()):
+            f.write("%s %d\n" % (stack, n))
+        f.close()
+
+def start():
+    "Start sampling stacks and timing the locks"
+    global tracing, sampler
+    for lock in locks.values():
+        lock.reset()
+    sampler = Sampler()
+    sampler.start()
+    tracing = True
+
+def stop(path):
+    """
+    Stop profiling, write the stacks to *path* and return a report of the
+    lock timings.
+    """
+    global tracing, sampler
+    tracing = False
+    stopped, sampler = sampler, None
+    stopped.stop()
+    stopped.write(path)
+    samples = sum(stopped.stacks.values())
+    return "%d stack samples written to %s\n" % (samples, path) + \
+           lockReport()
+
+def toggle(path):
+    "Start profiling if it is off, else stop it and return the report"
+    if sampler is None:
+        start()
+        return "Profiling started\n"
+    try:
+        return stop(path)
+    except IOError, e:
+        return "Could not write %s: %s\n" % (path, e)
+
+def _histogram(counts):
+    "The non-empty buckets of a histogram, as text"
+    return "  ".join(["<%dus:%d" % (2 ** n, c)
+                      for n, c in enumerate(counts) if c])
+
+def lockReport():
+    "The wait and hold histograms of each lock that was used"
+    lines = []
+    for lock in sorted(locks.values(), key=lambda l: l.name):
+        if sum(lock.waits) or sum(lock.holds):
+            lines.append("%s (%d acquires)" % (lock.name, sum(lock.waits)))
+            lines.append("    wait  " + _histogram(lock.waits))
+            lines.append("    hold  " + _histogram(lock.holds))
+    return "\n".join(lines) + "\n"
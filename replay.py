@@ -0,0 +1,234 @@
+#!/bin/env python
+"""
+**File:** replay.py
+
+Play a capture file (see capture.py) back against a chat server, to
+reproduce the load seen when it was recorded.  Each connection in the capture
+is opened, sends what it sent then and is closed, at the times it did then,
+scaled by ``--speed``.  A speed of 0 sends everything as fast as possible::
+
+    python chatserverStub.py --capture busy.cap
+    python replay.py busy.cap --port 50000 --speed 10
+
+While replaying, a pair of probe connections measure how long a message takes
+to get through the server: one sends a numbered probe message every
+``--probe`` seconds, and the other waits to receive it.  At the end the
+throughput of the replay is reported next to that of the recorded run, along
+with the probe latencies and how late the sends were against their schedule.
+"""
+
+import select
+import socket
+import threading
+import time
+from optparse import OptionParser
+
+import capture
+
+def percentiles(values):
+    "The 50th, 99th percentiles and maximum of a list of numbers"
+    if not values:
+        return (0.0, 0.0, 0.0)
+    values = sorted(values)
+    at = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+    return (at(0.5), at(0.99), values[-1])
+
+class Drain(threading.Thread):
+    """
+    Reads and throws away everything the server sends to the replayed
+    connections, so that the server never blocks on them.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(1)
+        self.lock = threading.Lock()
+        self.socks = []
+        self.nbytes = 0
+        self.done = threading.Event()
+
+    def add(self, sock):
+        self.lock.acquire()
+        self.socks.append(sock)
+        self.lock.release()
+
+    def remove(self, sock):
+        self.lock.acquire()
+        if sock in self.socks:
+            self.socks.remove(sock)
+        self.lock.release()
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+    def run(self):
+        while not self.done.isSet():
+            self.lock.acquire()
+            socks = list(self.socks)
+            self.lock.release()
+            if not socks:
+                time.sleep(0.05)
+                continue
+            try:
+                readable = select.select(socks, [], [], 0.1)[0]
+            except (select.error, socket.error):
+                continue       # a socket was closed under us
+            for sock in readable:
+                try:
+                    data = sock.recv(65536)
+                except socket.error:
+                    data = ''
+                if not data:
+                    self.remove(sock)
+                self.nbytes += len(data)
+
+class Probe(threading.Thread):
+    """
+    Sends a numbered probe message through the server every interval seconds
+    and times how long each takes to come out on a second connection.
+    """
+    def __init__(self, address, interval):
+        threading.Thread.__init__(self)
+        self.setDaemon(1)
+        self.sender = socket.create_connection(address)
+        self.receiver = socket.create_connection(address)
+        self.interval = interval
+        self.sent = {}             # probe number: time sent
+        self.latencies = []
+        self.done = threading.Event()
+
+    def run(self):
+        listener = threading.Thread(target=self.listen)
+        listener.setDaemon(1)
+        listener.start()
+        n = 0
+        while not self.done.isSet():
+            self.sent[n] = time.time()
+            self.sender.send("@@probe-%d@@" % n)
+            n += 1
+            self.done.wait(self.interval)
+
+    def listen(self):
+        data = ''
+        while True:
+            try:
+                more = self.receiver.recv(65536)
+            except socket.error:
+                return
+            if not more:
+                return
+            data += more
+            while '@@probe-' in data:
+                start = data.index('@@probe-')
+                end = data.find('@@', start + 8)
+                if end == -1:
+                    break
+                n = int(data[start + 8:end])
+                if n in self.sent:
+                    self.latencies.append(time.time() - self.sent.pop(n))
+                data = data[end + 2:]
+            # keep only what might be the start of a probe
+            data = data[-32:]
+
+    def stop(self):
+        self.done.set()
+        time.sleep(self.interval)   # give the last probe a chance
+        self.sender.close()
+        self.receiver.close()
+
+def replay(records, address, speed, drain):
+    """
+    Send the records to the server, returning the time taken, the number of
+    messages and bytes sent and how late each send was in seconds.
+    """
+    socks = {}
+    late = []
+    nmsgs = nbytes = 0
+    first = records[0][0]
+    began = time.time()
+    for when, connid, event, data in records:
+        if speed:
+            due = began + (when - first) / speed
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            late.append(max(0.0, -wait))
+        if event == capture.CONNECT:
+            try:
+                socks[connid] = socket.create_connection(address)
+            except socket.error, e:
+                print "Connection %d failed: %s" % (connid, e)
+                continue
+            drain.add(socks[connid])
+        elif connid not in socks:
+            continue
+        elif event == capture.DATA:
+            try:
+                socks[connid].sendall(data)
+            except socket.error:
+                continue
+            nmsgs += 1
+            nbytes += len(data)
+        elif event == capture.CLOSE:
+            sock = socks.pop(connid)
+            drain.remove(sock)
+            sock.close()
+    elapsed = time.time() - began
+    for sock in socks.values():
+        drain.remove(sock)
+        sock.close()
+    return elapsed, nmsgs, nbytes, late
+
+def main():
+    parser = OptionParser(usage="%prog [options] capture-file")
+    parser.add_option('--host', default='localhost',
+                      help='the chat server [default: %default]')
+    parser.add_option('--port', type='int', default=50000,
+                      help='50000 for chatserverStub, 8080 for xserver '
+                           '[default: %default]')
+    parser.add_option('--speed', type='float', default=1.0,
+                      help='times faster than recorded, 0 for as fast as '
+                           'possible [default: %default]')
+    parser.add_option('--probe', type='float', default=0.5, metavar='SECONDS',
+                      help='time between latency probes [default: %default]')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("give one capture file")
+    records = list(capture.read(args[0]))
+    if not records:
+        parser.error("%s has no records" % args[0])
+    address = (options.host, options.port)
+
+    # What the recorded run did
+    data = [r[3] for r in records if r[2] == capture.DATA]
+    duration = max(records[-1][0] - records[0][0], 1e-6)
+    conns = len([r for r in records if r[2] == capture.CONNECT])
+
+    drain = Drain()
+    drain.start()
+    probe = Probe(address, options.probe)
+    drain.add(probe.sender)        # it gets everything sent to the room
+    probe.start()
+    elapsed, nmsgs, nbytes, late = replay(records, address, options.speed,
+                                          drain)
+    probe.stop()
+    drain.stop()
+    elapsed = max(elapsed, 1e-6)
+
+    print "%-12s %10s %10s %12s %14s" % \
+          ('', 'seconds', 'messages', 'messages/s', 'bytes/s')
+    print "%-12s %10.2f %10d %12.1f %14.1f" % ('recorded', duration,
+            len(data), len(data) / duration, sum(map(len, data)) / duration)
+    print "%-12s %10.2f %10d %12.1f %14.1f" % ('replayed', elapsed,
+            nmsgs, nmsgs / elapsed, nbytes / elapsed)
+    print "%d connections, %d bytes received from the server" % \
+          (conns, drain.nbytes)
+    if options.speed:
+        print "Sends behind schedule (ms): p50 %.1f  p99 %.1f  max %.1f" % \
+              tuple([t * 1000 for t in percentiles(late)])
+    print "Probe latency (ms), %d probes, %d lost: p50 %.1f  p99 %.1f  " \
+          "max %.1f" % ((len(probe.latencies), len(probe.sent)) +
+          tuple([t * 1000 for t in percentiles(probe.latencies)]))
+
+if __name__ == '__main__':
+    main()
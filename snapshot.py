@@ -0,0 +1,39 @@
+"""
+**File:** snapshot.py
+
+Keep the state of the chat room in a file, so that a server that is restarted
+can carry on where the old one stopped: the messages in the queue, the index
+of the last one and the nicknames of the users that were connected.  Clients
+that come back with ``/resume`` then get just what they missed.
+
+The state is pickled to a temporary file which is then renamed over the old
+one, so a crash while saving never leaves a partly written snapshot.
+"""
+
+import os
+import cPickle as pickle
+
+def save(path, state):
+    "Write the state to path"
+    tmp = path + '.tmp'
+    f = open(tmp, 'wb')
+    pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.rename(tmp, path)
+
+def load(path):
+    "Return the state saved in path, or None if there is none"
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            return pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, ValueError):
+            print "Ignoring %s, it is not a snapshot" % path
+            return None
+    finally:
+        f.close()
@@ -42,7 +42,6 @@ import os
 import sys
 
 from chatnetworking import ChatConnect, defaulthost
-import rendezvous
 # import pdb
 
 xmax = 500
@@ -109,6 +108,8 @@ class ChatFrame(wx.Frame):
         self.panel.Layout()
 
         #-- Graphics now set-up, set-up Chat client
+        # Only the GUI needs rendezvous, chatnetworking does not load it
+        import rendezvous
         self.rendezvous = rendezvous.Rendezvous(
                                     self.connected,
                                     self.chatDisplay,
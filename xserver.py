@@ -1,38 +1,161 @@
 # chat_server.py
  
+import os
 import sys
+import time
+import errno
+import signal
 import socket
 import select
+import threading
+from collections import deque
+
+import capture
+import handoff
+from chunking import CHUNK_SIZE
 
 HOST = '' 
 SOCKET_LIST = []
 RECV_BUFFER = 4096 
 PORT = 8080
+HANDOFF_PATH = None             # see handoff.default_path()
+# the listening sockets: TCP, and a Unix domain socket if --unix is given
+LISTENERS = []
+UNIX_PATH = None
+# data waiting to be sent to each client: a deque of (message, bytes sent)
+OUTBOX = {}
+# bytes in each client's OUTBOX, a client over MAX_QUEUED is dropped
+QUEUED = {}
+MAX_QUEUED = 4 * 1024 * 1024
+# recording the traffic from the clients, see capture.py
+RECORDER = None
+CONN_IDS = {}
+# what each client has cost, see report()
+STATS = {}
+REPORT_TOP = 10
 
-def chat_server():
+# set by the handoff thread when a new server wants to take over,
+# and by the main loop once it has stopped using the sockets
+handing_off = threading.Event()
+stopped = threading.Event()
 
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.bind((HOST, PORT))
-    server_socket.listen(10)
- 
-    # add server socket object to the list of readable connections
-    SOCKET_LIST.append(server_socket)
+def stats(sock):
+    # the counters of a client, made when first used
+    if sock not in STATS:
+        STATS[sock] = {'peer': None, 'bytes_in': 0, 'msgs_in': 0, 'bytes_out': 0,
+                       'msgs_out': 0, 'would_block': 0,
+                       # seconds that data has waited to be sent to it
+                       'waited': 0.0, 'waiting_since': None}
+    return STATS[sock]
+
+# kept in the counters, so it is known after the client has gone
+def peer_name(sock):
+    counts = stats(sock)
+    if counts['peer'] is None:
+        if sock.family == socket.AF_UNIX:
+            counts['peer'] = "unix fd %d" % sock.fileno()
+        else:
+            try:
+                counts['peer'] = "%s:%s" % sock.getpeername()[:2]
+            except socket.error:
+                return "gone"
+    return counts['peer']
+
+def remove(sock):
+    if sock in SOCKET_LIST:
+        SOCKET_LIST.remove(sock)
+    OUTBOX.pop(sock, None)
+    QUEUED.pop(sock, None)
+    STATS.pop(sock, None)
+
+def listening(sock):
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN)
+
+def chat_server(takeover=False, capture_file=None, unix_path=None):
+    global RECORDER, UNIX_PATH, HANDOFF_PATH
+    HANDOFF_PATH = handoff.default_path('xserver.sock')
+    if capture_file:
+        RECORDER = capture.Capture(capture_file)
+
+    received = None
+    if takeover:
+        received = handoff.receive(HANDOFF_PATH)
+    if received:
+        # the listening sockets come first, then the clients
+        SOCKET_LIST.extend(received[0])
+        LISTENERS.extend([sock for sock in SOCKET_LIST if listening(sock)])
+        server_socket = LISTENERS[0]
+        for i, pending in received[1].items():
+            OUTBOX[SOCKET_LIST[i]] = pending
+            QUEUED[SOCKET_LIST[i]] = sum([len(message) - sent
+                                          for message, sent in pending])
+        for sock in SOCKET_LIST[len(LISTENERS):]:
+            sock.setblocking(0)
+        print "Took over %d clients from the old server" % (len(SOCKET_LIST) - len(LISTENERS))
+    else:
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((HOST, PORT))
+        server_socket.listen(10)
+
+        # add server socket object to the list of readable connections
+        SOCKET_LIST.append(server_socket)
+        LISTENERS.append(server_socket)
+
+    # clients on this host may skip TCP and use a Unix domain socket
+    for sock in LISTENERS:
+        if sock.family == socket.AF_UNIX:
+            UNIX_PATH = sock.getsockname()
+    if unix_path and not UNIX_PATH:
+        if os.path.exists(unix_path):
+            os.unlink(unix_path)
+        unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        unix_socket.bind(unix_path)
+        unix_socket.listen(10)
+        SOCKET_LIST.insert(len(LISTENERS), unix_socket)
+        LISTENERS.append(unix_socket)
+        UNIX_PATH = unix_path
+
+    t = threading.Thread(target=wait_for_successor)
+    t.setDaemon(1)
+    t.start()
+    signal.signal(signal.SIGUSR1, report)
  
     print "Chat server started on port " + str(PORT)
  
     while 1:
+        if handing_off.isSet():
+            # leave the sockets open, the handoff thread passes them on,
+            # or clears handing_off if the new server failed
+            stopped.set()
+            while handing_off.isSet():
+                time.sleep(0.1)
 
         # get the list sockets which are ready to be read through select
         # 4th arg, time_out  = 0 : poll and never block
-        ready_to_read,ready_to_write,in_error = select.select(SOCKET_LIST,[],[],0)
+        # and those with data waiting that are ready to be written
+        waiting = [sock for sock in SOCKET_LIST if sock in OUTBOX]
+        try:
+            ready_to_read,ready_to_write,in_error = select.select(SOCKET_LIST,waiting,[],0)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:    # the report() signal
+                continue
+            raise
       
         for sock in ready_to_read:
             # a new connection request recieved
-            if sock == server_socket: 
-                sockfd, addr = server_socket.accept()
+            if sock in LISTENERS: 
+                sockfd, addr = sock.accept()
+                # never block on send, see send_some()
+                sockfd.setblocking(0)
                 SOCKET_LIST.append(sockfd)
-                print "Client (%s, %s) connected" % addr
+                if sockfd.family == socket.AF_UNIX:
+                    print "Client connected on " + sock.getsockname()
+                else:
+                    print "Client (%s, %s) connected" % addr
+                if RECORDER:
+                    CONN_IDS[sockfd] = RECORDER.connection(time.time())
+                peer_name(sockfd)
                  
                # broadcast(server_socket, sockfd, "[%s:%s] entered our chatting room\n" % addr)
              
@@ -44,11 +167,17 @@ def chat_server():
                     data = sock.recv(RECV_BUFFER)
                     if data:
                         # there is something in the socket
+                        if RECORDER:
+                            RECORDER.data(time.time(), CONN_IDS.get(sock, 0), data)
+                        counts = stats(sock)
+                        counts['bytes_in'] += len(data)
+                        counts['msgs_in'] += 1
                         broadcast(server_socket,sock,data)  
                     else:
                         # remove the socket that's broken    
-                        if sock in SOCKET_LIST:
-                            SOCKET_LIST.remove(sock)
+                        remove(sock)
+                        if RECORDER:
+                            RECORDER.closed(time.time(), CONN_IDS.pop(sock, 0))
 
                         # at this stage, no data means probably the connection has been broken
                        # broadcast(server_socket, sock, "Client (%s, %s) is offline\n" % addr) 
@@ -58,22 +187,133 @@ def chat_server():
                    # broadcast(server_socket, sock, "Client (%s, %s) is offline\n" % addr)
                     continue
 
-    server_socket.close()
+        # each client gets up to a chunk of what is waiting for it in turn,
+        # so a large message does not hold up everyone else
+        for sock in ready_to_write:
+            if sock in OUTBOX:
+                send_some(sock)
+
+    for sock in LISTENERS:
+        sock.close()
     
-# broadcast chat messages to all connected clients
+# give the sockets to a new server process (started with --takeover)
+def handover():
+    handing_off.set()
+    stopped.wait()
+    print "Handing %d clients over to the new server" % (len(SOCKET_LIST) - len(LISTENERS))
+    pending = {}
+    for i, sock in enumerate(SOCKET_LIST):
+        if sock in OUTBOX:
+            pending[i] = OUTBOX[sock]
+    return list(SOCKET_LIST), pending
+
+def wait_for_successor():
+    while True:
+        if handoff.offer(HANDOFF_PATH, handover):
+            if RECORDER:
+                RECORDER.close()
+            # exit without closing the sockets, they belong to the new
+            # process now
+            os._exit(0)
+        print "The new server failed to take over, carrying on"
+        stopped.clear()
+        handing_off.clear()
+
+# broadcast chat messages to all connected clients, the main loop
+# sends them as the sockets are ready
 def broadcast (server_socket, sock, message):
+    now = time.time()
+    dropped = []
     for socket in SOCKET_LIST:
         # send the message only to peer
-        if socket != server_socket and socket != sock :
-            try :
-                socket.send(message)
-            except :
-                # broken socket connection
-                socket.close()
-                # broken socket, remove it
-                if socket in SOCKET_LIST:
-                    SOCKET_LIST.remove(socket)
+        if socket not in LISTENERS and socket != sock :
+            queued = QUEUED.get(socket, 0) + len(message)
+            if queued > MAX_QUEUED:
+                # it has stopped reading, don't hold its messages forever
+                dropped.append(socket)
+                continue
+            if socket not in OUTBOX:
+                OUTBOX[socket] = deque()
+                stats(socket)['waiting_since'] = now
+            OUTBOX[socket].append((message, 0))
+            QUEUED[socket] = queued
+    for socket in dropped:
+        print "Dropping %s, more than %d bytes are waiting for it" % \
+              (peer_name(socket), MAX_QUEUED)
+        socket.close()
+        remove(socket)
+
+# send up to CHUNK_SIZE of the data waiting for a client
+def send_some(sock):
+    pending = OUTBOX[sock]
+    message, sent = pending[0]
+    counts = stats(sock)
+    try :
+        n = sock.send(message[sent:sent + CHUNK_SIZE])
+    except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+            counts['would_block'] += 1
+            return
+        # broken socket connection
+        print "Send to %s failed, closing it: %s" % (peer_name(sock), e)
+        sock.close()
+        # broken socket, remove it
+        remove(sock)
+        return
+    sent += n
+    counts['bytes_out'] += n
+    QUEUED[sock] -= n
+    if sent == len(message):
+        pending.popleft()
+        counts['msgs_out'] += 1
+    else:
+        pending[0] = (message, sent)
+    if not pending:
+        del OUTBOX[sock]
+        del QUEUED[sock]
+        if counts['waiting_since'] is not None:
+            counts['waited'] += time.time() - counts['waiting_since']
+            counts['waiting_since'] = None
+
+# print the clients that the most data has waited for, on SIGUSR1
+def report(signum=None, frame=None):
+    now = time.time()
+    rows = []
+    for sock in SOCKET_LIST:
+        if sock in LISTENERS:
+            continue
+        counts = stats(sock)
+        waited = counts['waited']
+        if counts['waiting_since'] is not None:
+            waited += now - counts['waiting_since']
+        pending = OUTBOX.get(sock, ())
+        queued = QUEUED.get(sock, 0)
+        rows.append((waited, len(pending), queued, peer_name(sock), counts))
+    rows.sort(reverse=True)
+    print "%d clients, slowest first:" % len(rows)
+    print "  %-22s %10s %7s %10s %7s %9s %7s %7s %9s" % ('peer', 'bytes in',
+            'msgs', 'bytes out', 'msgs', 'waited', 'blocks', 'unsent',
+            'buffered')
+    for waited, unsent, queued, peer, counts in rows[:REPORT_TOP]:
+        print "  %-22s %10d %7d %10d %7d %8.2fs %7d %7d %9d" % (peer,
+                counts['bytes_in'], counts['msgs_in'], counts['bytes_out'],
+                counts['msgs_out'], waited, counts['would_block'], unsent,
+                queued)
  
 if __name__ == "__main__":
 
-    sys.exit(chat_server())         
\ No newline at end of file
+    capture_file = None
+    if '--capture' in sys.argv[1:-1]:
+        capture_file = sys.argv[sys.argv.index('--capture') + 1]
+    unix_path = None
+    if '--unix' in sys.argv[1:-1]:
+        unix_path = sys.argv[sys.argv.index('--unix') + 1]
+    try:
+        sys.exit(chat_server('--takeover' in sys.argv[1:], capture_file,
+                             unix_path))
+    finally:
+        # keep what was recorded when stopped with control-C
+        if RECORDER:
+            RECORDER.close()
+        if UNIX_PATH and not handing_off.isSet():
+            os.unlink(UNIX_PATH)         
\ No newline at end of file